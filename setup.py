@@ -38,7 +38,7 @@ class PyTest(TestCommand):
         sys.exit(errno)
 
 
-tests_requires = ['responses', 'testfixtures', 'pytest', 'freezegun']
+tests_requires = ['responses', 'testfixtures', 'pytest', 'freezegun', 'orjson']
 
 with open('src/oic/__init__.py', 'r') as fd:
     version = re.search(r'^__version__\s*=\s*[\'"]([^\'"]*)[\'"]',
@@ -83,6 +83,7 @@ setup(
         'types': ['types-requests'],
         'ldap_authn': ['python-ldap'],
         'examples': ['beaker'],
+        'orjson': ['orjson'],
     },
     install_requires=[
         "requests",
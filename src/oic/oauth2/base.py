@@ -78,7 +78,10 @@ class PBase(object):
             )
             self.settings.timeout = timeout
 
-        self.keyjar = keyjar or KeyJar(verify_ssl=self.settings.verify_ssl)
+        self.keyjar = keyjar or KeyJar(
+            verify_ssl=self.settings.verify_ssl,
+            requests_session=getattr(self.settings, "requests_session", None),
+        )
 
         self.cookiejar = cookielib.FileCookieJar()
 
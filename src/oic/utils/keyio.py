@@ -1,34 +1,50 @@
+import base64
 import builtins
 import copy
+import hashlib
 import json
 import logging
 import os
 import sys
 import time
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Union
 from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
 
 import requests
 from Cryptodome.PublicKey import RSA
 from jwkest import as_bytes
 from jwkest import as_unicode
 from jwkest import b64e
-from jwkest import jwe
-from jwkest import jws
 from jwkest.ecc import NISTEllipticCurve
+from jwkest.jwk import DeSerializationNotPossible
 from jwkest.jwk import ECKey
 from jwkest.jwk import JWKException
 from jwkest.jwk import RSAKey
 from jwkest.jwk import SYMKey
-from jwkest.jwk import rsa_load
+from jwkest.jwk import import_rsa_key
+from requests.adapters import HTTPAdapter
 
 from oic.exception import MessageException
 from oic.exception import PyoidcError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None  # type: ignore
+
 __author__ = "rohe0002"
 
 KEYLOADERR = "Failed to load %s key from '%s' (%s)"
@@ -37,6 +53,100 @@ MALFORMED = "Remote key update from {} failed, malformed JWKS."
 
 logger = logging.getLogger(__name__)
 
+# Connection pool sizes of the session shared by all KeyBundles
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 64
+
+_requests_session: Optional[requests.Session] = None
+
+
+def _default_requests_session() -> requests.Session:
+    """
+    Return the session used for fetching remote JWKS.
+
+    The session is shared so that connections (and TLS sessions) to the
+    jwks_uri endpoints are kept alive between refreshes.
+    """
+    global _requests_session
+    if _requests_session is None:
+        _session = requests.Session()
+        _adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+        )
+        _session.mount("https://", _adapter)
+        _session.mount("http://", _adapter)
+        _requests_session = _session
+    return _requests_session
+
+
+def _json_loads(data):
+    """Parse JSON from str or bytes, with orjson when it is available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj) -> str:
+    """Serialize to JSON, with orjson when it is available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            # orjson refuses integers wider than 64 bits, json does not
+            pass
+    return json.dumps(obj)
+
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on a '.lock' file next to path, where supported."""
+    if fcntl is None:
+        yield
+        return
+    with open("{}.lock".format(path), "a") as _lock:
+        fcntl.flock(_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(_lock, fcntl.LOCK_UN)
+
+
+def _read_jwks_cache(cache_file):
+    """
+    Read the on-disk cache of remote JWKS.
+
+    :param cache_file: Name of the cache file
+    :return: Dictionary with the JWKS source as key, empty if the file is
+        missing or unreadable
+    """
+    try:
+        with open(cache_file, "rb") as f:
+            _cache = _json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return _cache if isinstance(_cache, dict) else {}
+
+
+def _write_jwks_cache(cache_file, source, entry):
+    """
+    Store the cache entry for one JWKS source.
+
+    Other entries in the file are kept. The file is locked while it is
+    updated and replaced in one go, so concurrent writers do not clobber
+    each other or leave a half written file behind.
+    """
+    head = os.path.dirname(cache_file)
+    if head:
+        os.makedirs(head, exist_ok=True)
+
+    with _file_lock(cache_file):
+        _cache = _read_jwks_cache(cache_file)
+        _cache[source] = entry
+        _tmp = "{}.tmp".format(cache_file)
+        with open(_tmp, "w") as f:
+            f.write(_json_dumps(_cache))
+        os.replace(_tmp, cache_file)
+
 
 def raise_exception(excep, descr, error="service_error"):
     _err = json.dumps({"error": error, "error_description": descr})
@@ -63,6 +173,105 @@ K2C = {"RSA": RSAKey, "EC": ECKey, "oct": SYMKey}
 KEYS = Union[RSAKey, SYMKey, ECKey]
 
 
+def _b64_to_int(data):
+    """
+    Decode a base64url encoded big-endian integer.
+
+    Does the same as jwkest's base64_to_long, but lets int.from_bytes do the
+    conversion instead of going through a hex string byte by byte.
+    """
+    return int.from_bytes(base64.urlsafe_b64decode(data.encode("ascii") + b"=="), "big")
+
+
+@lru_cache(maxsize=256)
+def _rsa_public_key(n, e):
+    """
+    Construct a public RSA key from the base64url encoded JWK members.
+
+    The result is cached so that reloading the same JWKS (which happens on
+    every refresh of a remote key set) does not have to redo the bignum
+    conversions.
+
+    :param n: The modulus as it appears in the JWK
+    :param e: The exponent as it appears in the JWK
+    :return: A Cryptodome RSA key
+    """
+    try:
+        return RSA.construct((_b64_to_int(n), _b64_to_int(e)))
+    except ValueError as err:
+        raise DeSerializationNotPossible("%s" % err)
+
+
+def _rsa_from_jwk(**inst):
+    """Create a RSAKey, reusing cached public key material when possible."""
+    _n = inst.get("n")
+    _e = inst.get("e")
+    if _n and _e and isinstance(_n, str) and isinstance(_e, str) and "d" not in inst:
+        # RSAKey picks up the modulus and exponent from the key itself
+        del inst["n"], inst["e"]
+        inst["key"] = _rsa_public_key(_n, _e)
+    return RSAKey(**inst)
+
+
+def _key_signature(key):
+    """
+    Return a hashable value that is equal for keys that compare equal.
+
+    Mirrors the jwkest ``Key.__eq__`` check so duplicates can be detected
+    with a set lookup instead of comparing against every known key.
+    """
+    _vals = []
+    for member in key.public_members:
+        _val = getattr(key, member, None)
+        if isinstance(_val, list):
+            _val = tuple(_val)
+        _vals.append(_val)
+    return frozenset(key.__dict__), tuple(_vals)
+
+
+def _rsa_from_private_key(key):
+    """
+    Convert a cryptography RSA private key into a Cryptodome one.
+
+    The key has already been checked by OpenSSL when it was generated or
+    loaded, so the (slow) consistency check in Cryptodome is skipped.
+    """
+    _num = key.private_numbers()
+    return RSA.construct(
+        (_num.public_numbers.n, _num.public_numbers.e, _num.d, _num.p, _num.q),
+        consistency_check=False,
+    )
+
+
+def rsa_load(filename):
+    """
+    Read a PEM-encoded RSA key from a file.
+
+    Private keys are parsed by OpenSSL, anything else (e.g. public keys) is
+    left to Cryptodome.
+
+    :param filename: Name of the file
+    :return: A Cryptodome RSA key
+    """
+    # cryptography is only needed here and for key generation, importing it
+    # lazily keeps it out of the import time of this module.
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    with open(filename, "rb") as f:
+        pem = f.read()
+
+    try:
+        _key = serialization.load_pem_private_key(pem, password=None)
+    except (ValueError, TypeError, UnsupportedAlgorithm):
+        return import_rsa_key(pem)
+
+    if not isinstance(_key, rsa.RSAPrivateKey):
+        return import_rsa_key(pem)
+    return _rsa_from_private_key(_key)
+
+
 class KeyBundle(object):
     def __init__(
         self,
@@ -74,6 +283,8 @@ class KeyBundle(object):
         keytype="RSA",
         keyusage=None,
         timeout=5,
+        requests_session=None,
+        cache_file=None,
     ):
         """
         Initialize the KeyBundle.
@@ -87,6 +298,10 @@ class KeyBundle(object):
         :param timeout: Timeout for requests library. Can be specified either as
             a single integer or as a tuple of integers. For more details, refer to
             ``requests`` documentation.
+        :param requests_session: Instance of `requests.Session` used to fetch
+            remote keys. Defaults to a session shared by all KeyBundles.
+        :param cache_file: File where a remote JWKS and its ETag are kept, so
+            that they survive a restart. Not used if None.
         """
         self._keys: List[KEYS] = []
         self.remote = False
@@ -94,13 +309,19 @@ class KeyBundle(object):
         self.cache_time = cache_time
         self.time_out = 0
         self.etag = ""
+        self._body_sha = b""
         self.source: Optional[str] = None
         self.fileformat = fileformat.lower()
         self.keytype = keytype
         self.keyusage = keyusage
         self.imp_jwks: Dict[str, Any] = {}
+        self._jwks_cache: Dict[bool, Tuple[List[Any], str]] = {}
+        self._kty_index: Optional[Tuple[int, Dict[str, List[KEYS]]]] = None
+        self._version = 0
         self.last_updated: float = 0
         self.timeout = timeout
+        self.requests_session = requests_session
+        self.cache_file = cache_file
 
         if keys:
             self.source = None
@@ -124,6 +345,19 @@ class KeyBundle(object):
                     self.do_local_jwk(self.source)
                 elif self.fileformat == "der":  # Only valid for RSA keys
                     self.do_local_der(self.source, self.keytype, self.keyusage)
+            elif self.cache_file:
+                self._load_from_cache()
+
+    def _keys_changed(self):
+        """
+        Drop everything that is derived from the list of keys.
+
+        Must be called after the key list has changed. The version tells a
+        reader that ran concurrently that what it derived is already stale.
+        """
+        self._version += 1
+        self._kty_index = None
+        self._jwks_cache = {}
 
     def do_keys(self, keys):
         """
@@ -132,35 +366,60 @@ class KeyBundle(object):
         :param keys:
         :return:
         """
-        for inst in keys:
-            if not isinstance(inst, dict):
-                raise JWKSError("Illegal JWK")
+        self._load_keys(keys, list(self._keys))
 
-            typ = inst["kty"]
-            flag = 0
-            for _typ in [typ, typ.lower(), typ.upper()]:
-                try:
-                    _key = K2C[_typ](**inst)
-                except KeyError:
-                    continue
-                except TypeError:
-                    raise JWKSError("Inappropriate JWKS argument type")
-                except JWKException as err:
-                    logger.warning("Loading a key failed: %s", err)
-                else:
-                    if _key not in self._keys:
-                        self._keys.append(_key)
+    def _load_keys(self, keys, _keys):
+        """
+        Add the keys described by the JWKs to _keys, which replaces the key list.
+
+        The list is built on the side and assigned in one go, so concurrent
+        readers see either the old or the new keys, never a partial list.
+
+        :param keys: List of JWKs
+        :param _keys: List of keys to add to
+        """
+        _seen = {_key_signature(k) for k in _keys}
+        try:
+            for inst in keys:
+                if not isinstance(inst, dict):
+                    raise JWKSError("Illegal JWK")
+
+                typ = inst["kty"]
+                flag = 0
+                for _typ in [typ, typ.lower(), typ.upper()]:
+                    try:
+                        if K2C[_typ] is RSAKey:
+                            _key = _rsa_from_jwk(**inst)
+                        else:
+                            _key = K2C[_typ](**inst)
+                    except KeyError:
+                        continue
+                    except TypeError:
+                        raise JWKSError("Inappropriate JWKS argument type")
+                    except JWKException as err:
+                        logger.warning("Loading a key failed: %s", err)
+                    else:
+                        _sig = _key_signature(_key)
+                        if _sig not in _seen:
+                            _seen.add(_sig)
+                            _keys.append(_key)
                         flag = 1
                         break
-            if not flag:
-                logger.warning("Unknown key type: %s", typ)
+                if not flag:
+                    logger.warning("Unknown key type: %s", typ)
+        finally:
+            self._keys = _keys
+            self._keys_changed()
 
     def do_local_jwk(self, filename):
+        # Both parsers accept bytes, no need to decode the file as text first
+        with open(filename, "rb") as f:
+            _jwks = _json_loads(f.read())
+
         try:
-            with open(filename) as f:
-                self.do_keys(json.loads(f.read())["keys"])
+            self.do_keys(_jwks["keys"])
         except KeyError:
-            logger.error("Now 'keys' keyword in JWKS")
+            logger.error("No 'keys' keyword in JWKS")
             raise_exception(
                 UpdateFailed, "Local key update from '{}' failed.".format(filename)
             )
@@ -174,10 +433,8 @@ class KeyBundle(object):
         if not keyusage:
             keyusage = ["enc", "sig"]
 
-        for use in keyusage:
-            _key = RSAKey().load_key(_bkey)
-            _key.use = use
-            self._keys.append(_key)
+        self._keys = self._keys + [RSAKey(key=_bkey, use=use) for use in keyusage]
+        self._keys_changed()
 
         self.last_updated = time.time()
 
@@ -191,7 +448,8 @@ class KeyBundle(object):
 
         try:
             logger.debug("KeyBundle fetch keys from: %s", self.source)
-            r = requests.get(self.source, timeout=self.timeout, **args)
+            _session = self.requests_session or _default_requests_session()
+            r = _session.get(self.source, timeout=self.timeout, **args)
         except Exception as err:
             logger.error(err)
             raise_exception(UpdateFailed, REMOTE_FAILED.format(self.source, str(err)))
@@ -199,31 +457,41 @@ class KeyBundle(object):
         if r.status_code == 304:  # file has not changed
             self.time_out = time.time() + self.cache_time
             self.last_updated = time.time()
-            try:
-                self.do_keys(self.imp_jwks["keys"])
-            except KeyError:
-                logger.error("No 'keys' keyword in JWKS")
-                raise_exception(UpdateFailed, "No 'keys' keyword in JWKS")
-            else:
-                return False
+            if not self._keys:
+                try:
+                    self.do_keys(self.imp_jwks["keys"])
+                except KeyError:
+                    logger.error("No 'keys' keyword in JWKS")
+                    raise_exception(UpdateFailed, "No 'keys' keyword in JWKS")
+            return False
         elif r.status_code == 200:  # New content
             self.time_out = time.time() + self.cache_time
 
+            _sha = hashlib.sha256(r.content).digest()
+            if _sha == self._body_sha and self._keys:
+                # Same JWKS as last time, nothing to reparse
+                self.etag = r.headers.get("Etag", self.etag)
+                self.last_updated = time.time()
+                return False
+
             self.imp_jwks = self._parse_remote_response(r)
             if not isinstance(self.imp_jwks, dict) or "keys" not in self.imp_jwks:
                 raise_exception(UpdateFailed, MALFORMED.format(self.source))
 
-            logger.debug("Loaded JWKS: %s from %s" % (r.text, self.source))
             try:
-                self.do_keys(self.imp_jwks["keys"])
+                # The new keys replace the old ones in one go
+                self._load_keys(self.imp_jwks["keys"], [])
             except KeyError:
                 logger.error("No 'keys' keyword in JWKS")
                 raise_exception(UpdateFailed, MALFORMED.format(self.source))
 
+            self._body_sha = _sha
             try:
                 self.etag = r.headers["Etag"]
             except KeyError:
                 pass
+            if self.cache_file:
+                self._store_in_cache()
         else:
             raise_exception(
                 UpdateFailed, REMOTE_FAILED.format(self.source, r.status_code)
@@ -231,6 +499,42 @@ class KeyBundle(object):
         self.last_updated = time.time()
         return True
 
+    def _load_from_cache(self):
+        """
+        Pick up the keys of a remote source from the cache file.
+
+        The cache timer is not restored, so the first use still checks with
+        the server, but with the cached ETag that is normally answered with a
+        304 instead of a new JWKS.
+        """
+        entry = _read_jwks_cache(self.cache_file).get(self.source)
+        if not entry:
+            return
+
+        try:
+            _sha = bytes.fromhex(entry["sha256"])
+            self.do_keys(entry["jwks"]["keys"])
+        except (KeyError, TypeError, ValueError, JWKSError) as err:
+            logger.warning("Ignoring cached JWKS for %s: %s", self.source, err)
+            self._keys = []
+            self._keys_changed()
+            return
+
+        self.imp_jwks = entry["jwks"]
+        self.etag = entry.get("etag", "")
+        self._body_sha = _sha
+
+    def _store_in_cache(self):
+        entry = {
+            "etag": self.etag,
+            "sha256": self._body_sha.hex(),
+            "jwks": self.imp_jwks,
+        }
+        try:
+            _write_jwks_cache(self.cache_file, self.source, entry)
+        except OSError as err:
+            logger.warning("Could not cache JWKS from %s: %s", self.source, err)
+
     def _parse_remote_response(self, response):
         """
         Parse JWKS from the HTTP response.
@@ -251,9 +555,12 @@ class KeyBundle(object):
         except KeyError:
             pass
 
-        logger.debug("Loaded JWKS: %s from %s" % (response.text, self.source))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Loaded JWKS: %s from %s", response.text, self.source)
         try:
-            return json.loads(response.text)
+            # Parse the raw body, skipping the charset detection and decoding
+            # that response.text would do.
+            return _json_loads(response.content)
         except ValueError:
             return None
 
@@ -277,10 +584,10 @@ class KeyBundle(object):
         """
         res = True  # An update was successful
         if self.source:
-            # reread everything
-            self._keys = []
-
             if self.remote is False:
+                # reread everything
+                self._keys = []
+                self._keys_changed()
                 if self.fileformat == "jwk":
                     self.do_local_jwk(self.source)
                 elif self.fileformat == "der":
@@ -297,10 +604,21 @@ class KeyBundle(object):
         :return: If typ is undefined all the keys as a dictionary otherwise the appropriate keys in a list
         """
         self._uptodate()
-        _typs = [typ.lower(), typ.upper()]
 
         if typ:
-            return [k for k in self._keys if k.kty in _typs]
+            _cached = self._kty_index
+            if _cached is not None and _cached[0] == self._version:
+                _index = _cached[1]
+            else:
+                # If the keys change while the index is built, the version
+                # no longer matches and the next lookup builds it again
+                _version = self._version
+                _index = {}
+                for k in self._keys:
+                    _index.setdefault(k.kty.lower(), []).append(k)
+                if self._version == _version:
+                    self._kty_index = (_version, _index)
+            return list(_index.get(typ.lower(), []))
         else:
             return self._keys
 
@@ -325,28 +643,44 @@ class KeyBundle(object):
             ]
         else:
             self._keys = [k for k in self._keys if not k.kty == typ]
+        self._keys_changed()
 
     def __str__(self):
         return str(self.jwks())
 
     def jwks(self, private=False):
         self._uptodate()
-        keys = list()
-        for k in self._keys:
-            if private:
-                key = k.serialize(private)
-            else:
-                key = k.to_dict()
-                for k, v in key.items():
-                    key[k] = as_unicode(v)
-            keys.append(key)
-        return json.dumps({"keys": keys})
+        # Serializing means converting every key back to base64, only redo
+        # that if the keys (or anything that ends up in the JWKS) changed.
+        # Keys can be edited in place, so also compare the key material and
+        # the extra members.
+        _sigs = [(id(k.key), _key_signature(k), dict(k.extra_args)) for k in self._keys]
+        try:
+            _cached_sigs, _cached = self._jwks_cache[private]
+        except KeyError:
+            pass
+        else:
+            if _cached_sigs == _sigs:
+                return _cached
+
+        if private:
+            keys = [k.serialize(private) for k in self._keys]
+        else:
+            keys = [
+                {_m: as_unicode(_v) for _m, _v in k.to_dict().items()}
+                for k in self._keys
+            ]
+        _jwks = _json_dumps({"keys": keys})
+        self._jwks_cache[private] = (_sigs, _jwks)
+        return _jwks
 
     def append(self, key):
         self._keys.append(key)
+        self._keys_changed()
 
     def remove(self, key):
         self._keys.remove(key)
+        self._keys_changed()
 
     def __len__(self):
         return len(self._keys)
@@ -377,35 +711,21 @@ class KeyBundle(object):
 
         :param after: The length of time the key will remain in the KeyBundle before it should be removed.
         """
-        now = time.time()
-        if not isinstance(after, float):
-            try:
-                after = float(after)
-            except TypeError:
-                raise
-
-        _kl = []
-        for k in self._keys:
-            if k.inactive_since and k.inactive_since + after < now:
-                continue
-            else:
-                _kl.append(k)
-
-        self._keys = _kl
+        _limit = time.time() - float(after)
+        self._keys = [
+            k
+            for k in self._keys
+            if not (k.inactive_since and k.inactive_since < _limit)
+        ]
+        self._keys_changed()
 
 
 def keybundle_from_local_file(filename, typ, usage):
     if typ.upper() == "RSA":
         kb = KeyBundle()
-        k = RSAKey()
-        k.load(filename)
-        k.use = usage[0]
-        kb.append(k)
-        for use in usage[1:]:
-            _k = RSAKey()
-            _k.use = use
-            _k.load_key(k.key)
-            kb.append(_k)
+        _bkey = rsa_load(filename)
+        for use in usage:
+            kb.append(RSAKey(key=_bkey, use=use))
     elif typ.lower() == "jwk":
         kb = KeyBundle(source=filename, fileformat="jwk", keyusage=usage)
     else:
@@ -422,34 +742,42 @@ def dump_jwks(kbl, target, private=False):
     :param target: Name of the file to which everything should be written
     :param private: Should also the private parts be exported
     """
-    keys = []
-    for kb in kbl:
-        keys.extend(
-            [
-                k.serialize(private)
-                for k in kb.keys()
-                if k.kty != "oct" and not k.inactive_since
-            ]
-        )
-    res = {"keys": keys}
+    head = os.path.dirname(target)
+    if head:
+        os.makedirs(head, exist_ok=True)
+
+    # Serialize every key before the target is opened, a key that can not be
+    # serialized must not leave a truncated JWKS behind.
+    _keys = [
+        _json_dumps(k.serialize(private))
+        for kb in kbl
+        for k in kb.keys()
+        if k.kty != "oct" and not k.inactive_since
+    ]
 
-    try:
-        f = open(target, "w")
-    except IOError:
-        (head, tail) = os.path.split(target)
-        os.makedirs(head)
-        f = open(target, "w")
+    # Write straight to the target, so the mode of an existing file (0600 for
+    # private keys) and symlinks are kept as they are.
+    with open(target, "w") as f:
+        f.write('{"keys": [')
+        f.write(", ".join(_keys))
+        f.write("]}")
 
-    _txt = json.dumps(res)
-    f.write(_txt)
-    f.close()
+
+# Maps the names used by KeyJar.x_keys to key usages
+X_KEYS_USE = {"signing": "sig", "verify": "ver", "encrypt": "enc", "decrypt": "dec"}
 
 
 class KeyJar(object):
     """A keyjar contains a number of KeyBundles."""
 
     def __init__(
-        self, verify_ssl=True, keybundle_cls=KeyBundle, remove_after=3600, timeout=5
+        self,
+        verify_ssl=True,
+        keybundle_cls=KeyBundle,
+        remove_after=3600,
+        timeout=5,
+        requests_session=None,
+        jwks_cache_file=None,
     ):
         """
         Initialize the class.
@@ -458,11 +786,17 @@ class KeyJar(object):
         :param timeout: Timeout for requests library. Can be specified either as
             a single integer or as a tuple of integers. For more details, refer to
             ``requests`` documentation.
+        :param requests_session: Instance of `requests.Session` handed to the
+            KeyBundles that fetch remote keys.
+        :param jwks_cache_file: File in which the KeyBundles that fetch remote
+            keys keep the JWKS and ETags between restarts.
         :return:
         """
         self.issuer_keys: Dict[str, List[KeyBundle]] = {}
         self.verify_ssl = verify_ssl
         self.timeout = timeout
+        self.requests_session = requests_session
+        self.jwks_cache_file = jwks_cache_file
         self.keybundle_cls = keybundle_cls
         self.remove_after = remove_after
 
@@ -494,6 +828,11 @@ class KeyJar(object):
         if not url:
             raise KeyError("No jwks_uri")
 
+        if self.requests_session is not None:
+            kwargs.setdefault("requests_session", self.requests_session)
+        if self.jwks_cache_file is not None:
+            kwargs.setdefault("cache_file", self.jwks_cache_file)
+
         if "/localhost:" in url or "/localhost/" in url:
             kc = self.keybundle_cls(
                 source=url, verify_ssl=False, timeout=self.timeout, **kwargs
@@ -519,11 +858,13 @@ class KeyJar(object):
             self.issuer_keys[issuer].append(
                 self.keybundle_cls([{"kty": "oct", "k": _key}])
             )
-        else:
-            for use in usage:
-                self.issuer_keys[issuer].append(
-                    self.keybundle_cls([{"kty": "oct", "k": _key, "use": use}])
+        elif usage:
+            # One bundle holding a key per usage
+            self.issuer_keys[issuer].append(
+                self.keybundle_cls(
+                    [{"kty": "oct", "k": _key, "use": use} for use in usage]
                 )
+            )
 
     def add_kb(self, issuer, kb):
         try:
@@ -552,30 +893,15 @@ class KeyJar(object):
         :param kid: A Key Identifier
         :return: A possibly empty list of keys
         """
-        if key_use in ["dec", "enc"]:
-            use = "enc"
-        else:
-            use = "sig"
+        use = "enc" if key_use in ("dec", "enc") else "sig"
 
-        if issuer != "":
-            try:
-                _keys = self.issuer_keys[issuer]
-            except KeyError:
-                if issuer.endswith("/"):
-                    try:
-                        _keys = self.issuer_keys[issuer[:-1]]
-                    except KeyError:
-                        _keys = []
-                else:
-                    try:
-                        _keys = self.issuer_keys[issuer + "/"]
-                    except KeyError:
-                        _keys = []
-        else:
-            try:
-                _keys = self.issuer_keys[issuer]
-            except KeyError:
-                _keys = []
+        _keys = self.issuer_keys.get(issuer)
+        if _keys is None and issuer != "":
+            # Be lenient about a trailing slash in the issuer
+            if issuer.endswith("/"):
+                _keys = self.issuer_keys.get(issuer[:-1])
+            else:
+                _keys = self.issuer_keys.get(issuer + "/")
 
         lst: List[KEYS] = []
         if _keys:
@@ -601,15 +927,11 @@ class KeyJar(object):
         # if elliptic curve have to check I have a key of the right curve
         if key_type == "EC" and "alg" in kwargs:
             name = "P-{}".format(kwargs["alg"][2:])  # the type
-            _lst = []
-            for key in lst:
-                if name == key.crv:
-                    _lst.append(key)
-            lst = _lst
+            lst = [key for key in lst if key.crv == name]
 
         if use == "enc" and key_type == "oct" and issuer != "":
             # Add my symmetric keys
-            for kb in self.issuer_keys[""]:
+            for kb in self.issuer_keys.get("", []):
                 for key in kb.get(key_type):
                     if key.inactive_since:
                         continue
@@ -651,10 +973,10 @@ class KeyJar(object):
             return False
 
     def x_keys(self, var, part):
-        _func = getattr(self, "get_%s_key" % var)
+        _use = X_KEYS_USE[var]
 
-        keys = _func(key_type="", owner=part)
-        keys.extend(_func(key_type="", owner=""))
+        keys = self.get(_use, "", part)
+        keys.extend(self.get(_use, "", ""))
         return keys
 
     def verify_keys(self, part):
@@ -721,7 +1043,7 @@ class KeyJar(object):
         for _id, kbs in self.issuer_keys.items():
             _l: List[Dict[str, str]] = []
             for kb in kbs:
-                _l.extend(json.loads(kb.jwks())["keys"])
+                _l.extend(_json_loads(kb.jwks())["keys"])
             _res[_id] = {"keys": _l}
         return "%s" % (_res,)
 
@@ -840,7 +1162,12 @@ class KeyJar(object):
             ]
 
     def copy(self):
-        copy_keyjar = KeyJar(verify_ssl=self.verify_ssl, timeout=self.timeout)
+        copy_keyjar = KeyJar(
+            verify_ssl=self.verify_ssl,
+            timeout=self.timeout,
+            requests_session=self.requests_session,
+            jwks_cache_file=self.jwks_cache_file,
+        )
         for issuer, keybundles in self.issuer_keys.items():
             _kb = self.keybundle_cls(verify_ssl=self.verify_ssl, timeout=self.timeout)
             for kb in keybundles:
@@ -851,6 +1178,9 @@ class KeyJar(object):
         return copy_keyjar
 
     def keys_by_alg_and_usage(self, issuer, alg, usage):
+        from jwkest import jwe
+        from jwkest import jws
+
         if usage in ["sig", "ver"]:
             ktype = jws.alg2keytype(alg)
         else:
@@ -879,7 +1209,8 @@ class KeyJar(object):
             if len(sk) != len(ok):
                 return False
 
-            if not any(k in ok for k in sk):
+            _ok = {_key_signature(k) for k in ok}
+            if not any(_key_signature(k) in _ok for k in sk):
                 return False
 
         return True
@@ -933,11 +1264,11 @@ def key_setup(vault, **kwargs):
     :return: 2-tuple: result of urlsplit and a dictionary with parameter name as key and url and value
     """
     vault_path = proper_path(vault)
-
-    if not os.path.exists(vault_path):
-        os.makedirs(vault_path)
+    os.makedirs(vault_path, exist_ok=True)
 
     kb = KeyBundle()
+    # The same RSA key is used for all usages, only load or create it once
+    _key = None
     for usage in ["sig", "enc"]:
         if usage in kwargs:
             if kwargs[usage] is None:
@@ -945,12 +1276,13 @@ def key_setup(vault, **kwargs):
 
             _args = kwargs[usage]
             if _args["alg"].upper() == "RSA":
-                try:
-                    _key = rsa_load("%s%s" % (vault_path, "pyoidc"))
-                except Exception:
-                    with open(os.devnull, "w") as devnull:
-                        with RedirectStdStreams(stdout=devnull, stderr=devnull):
-                            _key = create_and_store_rsa_key_pair(path=vault_path)
+                if _key is None:
+                    try:
+                        _key = rsa_load("%s%s" % (vault_path, "pyoidc"))
+                    except Exception:
+                        with open(os.devnull, "w") as devnull:
+                            with RedirectStdStreams(stdout=devnull, stderr=devnull):
+                                _key = create_and_store_rsa_key_pair(path=vault_path)
 
                 k = RSAKey(key=_key, use=usage)
                 k.add_kid()
@@ -972,15 +1304,9 @@ def key_export(baseurl, local_path, vault, keyjar, **kwargs):
     part = urlsplit(baseurl)
 
     # deal with the export directory
-    if part.path.endswith("/"):
-        _path = part.path[:-1]
-    else:
-        _path = part.path[:]
-
-    local_path = proper_path("%s/%s" % (_path, local_path))
-
-    if not os.path.exists(local_path):
-        os.makedirs(local_path)
+    _path = part.path[:-1] if part.path.endswith("/") else part.path
+    local_path = proper_path("{}/{}".format(_path, local_path))
+    os.makedirs(local_path, exist_ok=True)
 
     kb = key_setup(vault, **kwargs)
 
@@ -995,9 +1321,7 @@ def key_export(baseurl, local_path, vault, keyjar, **kwargs):
     with open(_export_filename, "w") as f:
         f.write(str(kb))
 
-    _url = "%s://%s%s" % (part.scheme, part.netloc, _export_filename[1:])
-
-    return _url
+    return urlunsplit((part.scheme, part.netloc, _export_filename[1:], "", ""))
 
 
 # ================= create RSA key ======================
@@ -1012,21 +1336,35 @@ def create_and_store_rsa_key_pair(name="pyoidc", path=".", size=2048):
     :param size: RSA key size
     :return: RSA key
     """
-    key = RSA.generate(size)
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=size)
 
     os.makedirs(path, exist_ok=True)
 
     if name:
         with open(os.path.join(path, name), "wb") as f:
-            f.write(key.exportKey("PEM"))
+            f.write(
+                key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.TraditionalOpenSSL,
+                    encryption_algorithm=serialization.NoEncryption(),
+                )
+            )
 
-        _pub_key = key.publickey()
         with open(os.path.join(path, "{}.pub".format(name)), "wb") as f:
-            f.write(_pub_key.exportKey("PEM"))
+            f.write(
+                key.public_key().public_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PublicFormat.SubjectPublicKeyInfo,
+                )
+            )
 
-    return key
+    return _rsa_from_private_key(key)
 
 
+@lru_cache(maxsize=128)
 def proper_path(path):
     """
     Clean up the path specification so it looks like something I could use.
@@ -1038,8 +1376,7 @@ def proper_path(path):
     elif path.startswith("/"):
         path = ".%s" % path
     elif path.startswith("."):
-        while path.startswith("."):
-            path = path[1:]
+        path = path.lstrip(".")
         if path.startswith("/"):
             path = ".%s" % path
     else:
@@ -1225,6 +1562,8 @@ def check_key_availability(inst, jwt):
     :param inst: OP instance
     :param jwt: A JWT that has to be verified or decrypted
     """
+    from jwkest import jws
+
     _rj = jws.factory(jwt)
     payload = json.loads(as_unicode(_rj.jwt.part[1]))
     _cid = payload["iss"]
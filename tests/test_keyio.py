@@ -10,23 +10,30 @@ from unittest import TestCase
 from unittest.mock import sentinel
 
 import pytest
+import requests
 import responses
 from freezegun import freeze_time
+from jwkest.jwk import SerializationNotPossible
 from jwkest.jws import JWS
 
 from oic.oauth2.message import MissingSigningKey
 from oic.oic import AuthorizationResponse
 from oic.oic.provider import Provider
+from oic.utils import keyio
 from oic.utils.keyio import JWKSError
 from oic.utils.keyio import KeyBundle
 from oic.utils.keyio import KeyJar
 from oic.utils.keyio import RSAKey
 from oic.utils.keyio import build_keyjar
 from oic.utils.keyio import check_key_availability
+from oic.utils.keyio import create_and_store_rsa_key_pair
 from oic.utils.keyio import dump_jwks
 from oic.utils.keyio import key_export
+from oic.utils.keyio import key_setup
 from oic.utils.keyio import keybundle_from_local_file
+from oic.utils.keyio import proper_path
 from oic.utils.keyio import rsa_init
+from oic.utils.keyio import rsa_load
 
 __author__ = "rohe0002"
 
@@ -51,6 +58,16 @@ with open(os.path.join(jwks_folder, "jwks_fault.json")) as f:
     JWKS_ERR_1 = json.load(f)
 
 
+@pytest.fixture(params=["orjson", "json"])
+def json_backend(request, monkeypatch):
+    """Run the test with orjson and with the json fallback."""
+    if request.param == "json":
+        monkeypatch.setattr(keyio, "orjson", None)
+    elif keyio.orjson is None:
+        pytest.skip("orjson is not installed")
+    return request.param
+
+
 def test_rsa_init(tmpdir):
     path = tmpdir.strpath
     res = rsa_init(
@@ -64,6 +81,7 @@ def test_rsa_init(tmpdir):
     assert res
 
 
+@pytest.mark.usefixtures("json_backend")
 def test_keybundle_from_local_jwk_file():
     kb = keybundle_from_local_file(
         "file://{}".format(os.path.join(BASE_PATH, "jwk.json")), "jwk", ["ver", "sig"]
@@ -137,6 +155,7 @@ def test_build_keyjar_missing(tmpdir):
     assert "RSA" in kidd["sig"]
 
 
+@pytest.mark.usefixtures("json_backend")
 def test_dump_public_jwks():
     keys = [
         {"type": "RSA", "use": ["enc", "sig"]},
@@ -158,6 +177,7 @@ def test_dump_public_jwks():
             assert not k.d
 
 
+@pytest.mark.usefixtures("json_backend")
 def test_dump_private_jwks():
     keys = [
         {"type": "RSA", "use": ["enc", "sig"]},
@@ -408,6 +428,41 @@ class TestKeyJar(object):
         except MissingSigningKey:
             authz_resp.verify(keyjar=kj, sender=ISSUER, skew=100000000)
 
+    def test_equal(self):
+        kj1 = KeyJar()
+        kj1.import_jwks(JWK1, "https://example.com")
+        kj2 = KeyJar()
+        kj2.import_jwks(JWK1, "https://example.com")
+
+        assert kj1 == kj2
+        assert kj1 == kj1.copy()
+
+    def test_not_equal(self):
+        kj = KeyJar()
+        kj.import_jwks(JWK0, "https://example.com")
+
+        other_issuer = KeyJar()
+        other_issuer.import_jwks(JWK0, "https://example.org")
+        assert kj != other_issuer
+
+        more_keys = KeyJar()
+        more_keys.import_jwks(JWK1, "https://example.com")
+        assert kj != more_keys
+
+        assert kj != JWK0
+
+    @pytest.mark.parametrize("member,value", [("kid", "other"), ("use", "enc")])
+    def test_not_equal_single_member(self, member, value):
+        kj1 = KeyJar()
+        kj1.import_jwks(JWK0, "https://example.com")
+
+        _key = dict(JWK0["keys"][0])
+        _key[member] = value
+        kj2 = KeyJar()
+        kj2.import_jwks({"keys": [_key]}, "https://example.com")
+
+        assert kj1 != kj2
+
 
 def test_import_jwks():
     kj = KeyJar()
@@ -498,6 +553,7 @@ def test_reload():
     assert len(kb) == 1
 
 
+@pytest.mark.usefixtures("json_backend")
 def test_parse_remote_response(
     caplog,
 ):  # noqa: D202 - inline class requires a blank line
@@ -507,6 +563,7 @@ def test_parse_remote_response(
         def __init__(self, header):
             self.headers = {"Content-Type": header}
             self.text = "{}"
+            self.content = b"{}"
 
     with caplog.at_level(logging.WARNING, logger="oic.utils.keyio"):
         kb_public = KeyBundle(source="file://./foo.jwks")
@@ -570,15 +627,16 @@ class TestCheckKeyAvailability(TestCase):
         self.server.cdb["some_cid"] = {"client_secret": "top secret"}
         check_key_availability(self.server, self.jwt)
         self.assertTrue("some_cid" in self.server.keyjar)
-        # Two symmetric
-        self.assertEqual(len(self.server.keyjar["some_cid"]), 2)
+        # One bundle with two symmetric keys
+        self.assertEqual(len(self.server.keyjar["some_cid"]), 1)
+        self.assertEqual(len(self.server.keyjar["some_cid"][0]), 2)
 
     def test_jwks(self):
         self.server.cdb["some_cid"] = {"client_secret": "top secret", "jwks": JWK0}
         check_key_availability(self.server, self.jwt)
         self.assertTrue("some_cid" in self.server.keyjar)
-        # Two symmetric and one remote
-        self.assertEqual(len(self.server.keyjar["some_cid"]), 3)
+        # One symmetric and one remote
+        self.assertEqual(len(self.server.keyjar["some_cid"]), 2)
 
     def test_jwks_uri(self):
         self.server.cdb["some_cid"] = {
@@ -587,5 +645,352 @@ class TestCheckKeyAvailability(TestCase):
         }
         check_key_availability(self.server, self.jwt)
         self.assertTrue("some_cid" in self.server.keyjar)
-        # Two symmetric and one remote
-        self.assertEqual(len(self.server.keyjar["some_cid"]), 3)
+        # One symmetric and one remote
+        self.assertEqual(len(self.server.keyjar["some_cid"]), 2)
+
+
+def test_rsa_public_key_reused_on_reload():
+    kb = KeyBundle(JWK0["keys"])
+    _key = kb.keys()[0]
+
+    kb2 = KeyBundle(JWK0["keys"])
+    _key2 = kb2.keys()[0]
+
+    assert _key.key is _key2.key
+    assert _key == _key2
+    assert _key.serialize() == _key2.serialize()
+
+
+class TestKeyBundleRemote(object):
+    source = "https://example.com/jwks.json"
+
+    def test_unchanged_content_not_reparsed(self):
+        kb = KeyBundle(source=self.source)
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, json=JWK0)
+            rsps.add(responses.GET, self.source, json=JWK0)
+            assert kb.update() is True
+            _keys = kb.keys()
+            assert len(_keys) == 1
+
+            assert kb.update() is False
+            assert kb.keys() == _keys
+            assert kb.keys()[0] is _keys[0]
+
+    def test_changed_content_replaces_keys(self):
+        kb = KeyBundle(source=self.source)
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, json=JWK0)
+            rsps.add(responses.GET, self.source, json=JWK1)
+            assert kb.update() is True
+            assert len(kb) == 1
+            assert kb.update() is True
+            assert len(kb) == 2
+
+    @pytest.mark.usefixtures("json_backend")
+    def test_cache_file_survives_restart(self, tmpdir):
+        cache_file = os.path.join(tmpdir.strpath, "cache", "jwks.json")
+        kb = KeyBundle(source=self.source, cache_file=cache_file)
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, json=JWK0, headers={"Etag": "abc"})
+            kb.update()
+        assert os.path.isfile(cache_file)
+
+        # A new instance, as after a restart, starts out with the cached keys
+        kb2 = KeyBundle(source=self.source, cache_file=cache_file)
+        assert len(kb2.available_keys()) == 1
+        assert kb2.etag == "abc"
+
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, status=304)
+            assert len(kb2.keys()) == 1
+            assert rsps.calls[0].request.headers["If-None-Match"] == "abc"
+
+    def test_broken_cache_file_is_ignored(self, tmpdir):
+        cache_file = os.path.join(tmpdir.strpath, "jwks.json")
+        with open(cache_file, "w") as f:
+            f.write("not json")
+
+        kb = KeyBundle(source=self.source, cache_file=cache_file)
+        assert kb.available_keys() == []
+        assert kb.etag == ""
+
+    def test_get_during_refresh(self, monkeypatch):
+        kb = KeyBundle(source=self.source)
+        _build = keyio._rsa_from_jwk
+        _seen = []
+
+        def _rsa_from_jwk(**inst):
+            # Another thread looking up keys while the JWKS is being parsed
+            _seen.append(len(kb.get("RSA")))
+            _seen.append(len(kb.keys()))
+            return _build(**inst)
+
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, json=JWK0)
+            rsps.add(responses.GET, self.source, json=JWK2)
+            kb.update()
+            monkeypatch.setattr(keyio, "_rsa_from_jwk", _rsa_from_jwk)
+            kb.update()
+
+        # Readers only ever see the old keys, never a partial list
+        assert _seen == [1] * 8
+        assert len(kb) == 4
+        assert len(kb.get("RSA")) == 4
+
+    def test_keyjar_copy_keeps_cache_file(self, tmpdir):
+        cache_file = os.path.join(tmpdir.strpath, "jwks.json")
+        kj = KeyJar(jwks_cache_file=cache_file).copy()
+        assert kj.jwks_cache_file == cache_file
+
+        kb = kj.add("https://example.com", self.source)
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, json=JWK0)
+            kb.update()
+        assert os.path.isfile(cache_file)
+
+    def test_not_modified_keeps_keys_and_etag(self):
+        kb = KeyBundle(source=self.source)
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, self.source, json=JWK0, headers={"Etag": "abc"})
+            rsps.add(responses.GET, self.source, status=304)
+            kb.update()
+            _key = kb.keys()[0]
+
+            assert kb.update() is False
+            assert kb.etag == "abc"
+            assert rsps.calls[1].request.headers["If-None-Match"] == "abc"
+            assert kb.keys()[0] is _key
+
+
+def test_do_keys_skips_duplicates(caplog):
+    kb = KeyBundle()
+    with caplog.at_level(logging.WARNING, logger="oic.utils.keyio"):
+        kb.do_keys(JWK1["keys"] + JWK1["keys"])
+    assert len(kb) == 2
+    assert caplog.record_tuples == []
+
+    kb.do_keys(JWK0["keys"])
+    kb.do_keys(JWK1["keys"])
+    assert len(kb) == 3
+
+
+@pytest.mark.usefixtures("json_backend")
+def test_jwks_cache_follows_key_changes():
+    kb = KeyBundle(JWK1["keys"])
+    _jwks = kb.jwks()
+    assert kb.jwks() is _jwks
+
+    kb.keys()[0].kid = "changed"
+    _new = kb.jwks()
+    assert _new != _jwks
+    assert "changed" in _new
+
+    kb.remove(kb.keys()[0])
+    assert len(json.loads(kb.jwks())["keys"]) == 1
+
+
+def test_keybundle_get_by_type_changed_while_indexing():
+    kb = KeyBundle(JWK1["keys"])
+
+    class _Kty(str):
+        def lower(self):
+            # Another thread removes the key while this one builds the index
+            kb.remove_key("RSA")
+            return str.lower(self)
+
+    kb.get("RSA")[0].kty = _Kty("RSA")
+    kb.remove_key("oct")  # Drop the index, so the next lookup rebuilds it
+    assert len(kb.get("RSA")) == 1
+    assert kb.get("RSA") == []
+
+
+def test_jwks_cache_private_key_replaced_by_public_half():
+    _key = RSAKey(key=rsa_load(RSA0), kid="rsa1", use="sig")
+    kb = KeyBundle()
+    kb.append(_key)
+    assert '"d"' in kb.jwks(private=True)
+
+    kb.remove(_key)
+    kb.append(RSAKey(key=_key.key.publickey(), kid="rsa1", use="sig"))
+
+    assert '"d"' not in kb.jwks()
+    assert '"d"' not in kb.jwks(private=True)
+
+
+@pytest.mark.usefixtures("json_backend")
+def test_export_import_jwks():
+    kj = KeyJar()
+    kj.import_jwks(JWKS_SPO, "https://example.com")
+    _jwks = kj.export_jwks(issuer="https://example.com")
+
+    kj2 = KeyJar()
+    kj2.import_jwks(_jwks, "https://example.com")
+    assert kj2 == kj
+    assert kj2.export_jwks(issuer="https://example.com") == _jwks
+
+
+@pytest.mark.usefixtures("json_backend")
+def test_jwks_with_wide_integer():
+    kb = KeyBundle(JWK0["keys"])
+    kb.keys()[0].extra_args["wide"] = 2**70
+    assert json.loads(kb.jwks())["keys"][0]["wide"] == 2**70
+
+
+def test_keybundle_get_by_type_after_changes():
+    kb = KeyBundle(JWK1["keys"])
+    assert len(kb.get("RSA")) == 1
+    assert len(kb.get("OCT")) == 1
+
+    _rsa = kb.get("rsa")[0]
+    kb.remove(_rsa)
+    assert kb.get("RSA") == []
+
+    kb.append(_rsa)
+    assert kb.get("RSA") == [_rsa]
+
+    kb.remove_key("oct")
+    assert kb.get("oct") == []
+
+
+def test_create_and_load_rsa_key_pair(tmpdir):
+    path = tmpdir.strpath
+    key = create_and_store_rsa_key_pair("rsa_key", path=path, size=1024)
+    assert key.has_private()
+    assert key.size_in_bits() == 1024
+
+    _key = rsa_load(os.path.join(path, "rsa_key"))
+    assert _key.has_private()
+    assert _key == key
+
+    _pub = rsa_load(os.path.join(path, "rsa_key.pub"))
+    assert not _pub.has_private()
+    assert _pub == key.publickey()
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("./keys", "./keys/"),
+        ("/keys/", "./keys/"),
+        ("keys", "./keys/"),
+        ("../keys", "./keys/"),
+        (".../keys/", "./keys/"),
+        # Same as the original loop, dots are dropped without adding "./"
+        (".keys", "keys/"),
+    ],
+)
+def test_proper_path(path, expected):
+    assert proper_path(path) == expected
+
+
+def test_remote_keys_with_custom_session():
+    source = "https://example.com/jwks.json"
+    session = requests.Session()
+    kj = KeyJar(requests_session=session)
+    kb = kj.add("https://example.com", source)
+    assert kb.requests_session is session
+
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, source, json=JWK0)
+        assert len(kb.keys()) == 1
+
+
+def test_keyjar_copy_keeps_session():
+    session = requests.Session()
+    kj = KeyJar(requests_session=session)
+    kj.import_jwks(JWK0, "https://example.com")
+
+    kj2 = kj.copy()
+    assert kj2.requests_session is session
+    kb = kj2.add("https://example.org", "https://example.org/jwks.json")
+    assert kb.requests_session is session
+
+
+def test_add_symmetric_usages_in_one_bundle():
+    kj = KeyJar()
+    kj.add_symmetric("client", "secret", ["enc", "sig"])
+    assert len(kj["client"]) == 1
+    assert [k.use for k in kj["client"][0].keys()] == ["enc", "sig"]
+    assert len(kj.get_signing_key("oct", "client")) == 1
+
+
+def test_key_setup_shares_rsa_key(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    vault = "vault"
+    kb = key_setup(vault, sig={"alg": "RSA"}, enc={"alg": "RSA"})
+    _sig, _enc = kb.keys()
+    assert _sig.use == "sig"
+    assert _enc.use == "enc"
+    assert _sig.key is _enc.key
+
+    # The key is stored in the vault and reused
+    kb = key_setup(vault, sig={"alg": "RSA"})
+    assert kb.keys()[0].key == _sig.key
+
+
+def test_verify_and_decrypt_keys():
+    kj = KeyJar()
+    kj.import_jwks(JWK0, "")
+    kj.import_jwks(JWK1, "https://example.com")
+
+    _ver = kj.verify_keys("https://example.com")
+    assert _ver == kj.get_verify_key(owner="https://example.com") + kj.get_verify_key()
+    _dec = kj.decrypt_keys("https://example.com")
+    assert (
+        _dec == kj.get_decrypt_key(owner="https://example.com") + kj.get_decrypt_key()
+    )
+
+
+def test_get_symmetric_enc_key_without_own_keys():
+    kj = KeyJar()
+    kj.add_symmetric("https://example.com/", "secret", ["enc"])
+    # No keys of my own, and the issuer is given without the trailing slash
+    keys = kj.get_encrypt_key("oct", "https://example.com")
+    assert len(keys) == 1
+
+
+def test_dump_jwks_creates_directory(tmpdir):
+    kb = KeyBundle(JWK1["keys"])
+    target = os.path.join(tmpdir.strpath, "export", "jwks.json")
+    dump_jwks([kb], target)
+
+    with open(target) as f:
+        jwks = json.load(f)
+    # The symmetric key is never exported
+    assert [k["kty"] for k in jwks["keys"]] == ["RSA"]
+    assert os.listdir(os.path.dirname(target)) == ["jwks.json"]
+
+
+def test_dump_jwks_failure_keeps_old_file(tmpdir):
+    target = os.path.join(tmpdir.strpath, "jwks.json")
+    dump_jwks([KeyBundle(JWK0["keys"])], target)
+    with open(target) as f:
+        _old = f.read()
+
+    kb = KeyBundle(JWK0["keys"])
+    # No key material, can not be serialized
+    kb.append(RSAKey(use="sig"))
+    with pytest.raises(SerializationNotPossible):
+        dump_jwks([kb], target)
+
+    with open(target) as f:
+        assert f.read() == _old
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX file modes and symlinks")
+def test_dump_jwks_keeps_file_mode(tmpdir):
+    kb = KeyBundle(JWK1["keys"])
+    target = os.path.join(tmpdir.strpath, "jwks.json")
+    with open(target, "w"):
+        pass
+    os.chmod(target, 0o600)
+    link = os.path.join(tmpdir.strpath, "link.json")
+    os.symlink(target, link)
+
+    dump_jwks([kb], link, private=True)
+
+    assert os.path.islink(link)
+    assert os.stat(target).st_mode & 0o777 == 0o600
+    with open(target) as f:
+        assert [k["kty"] for k in json.load(f)["keys"]] == ["RSA"]